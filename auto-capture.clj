@@ -5,13 +5,20 @@
 (require '[clojure.java.io :as io])
 (require '[clj-http.lite.client :as client])
 (import '(java.util Base64 UUID)
-         '(java.nio.file Files Paths)
-         '(java.text SimpleDateFormat)
-         '(java.util Date))
+         '(java.nio.file CopyOption Files Paths StandardCopyOption)
+         '(java.time Instant)
+         '(java.time.temporal ChronoUnit))
 
 (def openai-api-key (System/getenv "OPENAI_API_KEY"))
 
-;; Function to post base64 image frame to OpenAI API and return the response body
+;; OpenAI error bodies look like {"error" {"message" ...}}; fall back to the raw body if it isn't JSON
+(defn openai-error-message [body]
+  (try
+    (or (:message (:error (json/parse-string body true))) body)
+    (catch Exception _
+      body)))
+
+;; Function to post base64 image frame to OpenAI API and return the description text
 (defn oai-image-description [frame]
   (let [response (client/post "https://api.openai.com/v1/chat/completions"
                               {:headers {"Content-Type" "application/json"
@@ -24,20 +31,25 @@
                                                                                    :image_url {:url (str "data:image/jpeg;base64," frame)}}]}]
                                                             :max_tokens 300})
                                :throw false})]
-    (let [response-body (:body response)]
-      (println "Response body:" response-body)
-      response-body)))
+    ;; Fail loudly so the caller logs the error instead of storing a nil description
+    (when-not (<= 200 (:status response) 299)
+      (throw (Exception. (str "OpenAI request failed (HTTP " (:status response) "): " (openai-error-message (:body response))))))
+    (let [response-body (json/parse-string (:body response) true)
+          content (:content (:message (first (:choices response-body))))]
+      (when (nil? content)
+        (throw (Exception. (str "OpenAI response had no content: " (or (:error response-body) (:body response))))))
+      (println "Response content:" content)
+      content)))
 
 ;; Define the destination folder on the desktop
 (def destination-folder (str (System/getProperty "user.home") "/Desktop/screencapture/"))
 
 ;; Create the directory if it does not exist
-(shell "mkdir" "-p" destination-folder)
+(.mkdirs (io/file destination-folder))
 
-;; Function to generate a timestamp string in ISO 8601 format
+;; Function to generate a UTC timestamp string in ISO 8601 format
 (defn timestamp-iso-str []
-  (let [sdf (SimpleDateFormat. "yyyy-MM-dd'T'HH:mm:ss'Z'")]
-    (.format sdf (Date.))))
+  (str (.truncatedTo (Instant/now) ChronoUnit/SECONDS)))
 
 ;; Function to generate a UUID v4 string
 (defn uuid-v4 []
@@ -53,43 +65,94 @@
       (println "Error converting image to Base64:" (.getMessage e))
       nil))) ;; Return nil to indicate failure
 
-;; Function to save a JSON hypergraph to a file
+;; Function to save a JSON hypergraph to a file, replacing it atomically
 (defn save-json-hypergraph [json-object path]
-  (with-open [writer (io/writer path)]
-    (.write writer (json/generate-string json-object))
-    (.flush writer)))
-
-;; Function to save screenshot
-(defn capture-screenshot []
-  (let [temp-file (str "/tmp/" (uuid-v4) ".png")]
-    (println "Capturing screenshot to:" temp-file)
-    (shell "screencapture" "-x" temp-file)
+  ;; Unique temp name so overlapping saves (e.g. the shutdown hook during a flush) never share a file
+  (let [temp-file (io/file (str path "." (UUID/randomUUID) ".tmp"))]
     (try
-      (let [file (io/file temp-file)]
-        (when (.exists file)
-          (println "Screenshot saved to:" (.getAbsolutePath file))
-          (let [base64 (image-to-base64 temp-file)]
-  ;;          (println "Base64 string:" base64) ;; This will print the Base64 string
-            base64)))
-      (catch Exception e
-        (println "Error capturing screenshot:" (.getMessage e)))
+      (with-open [writer (io/writer temp-file)]
+        (json/generate-stream json-object writer))
+      ;; Swap the finished file into place so an interrupted write never truncates the hypergraph
+      (Files/move (.toPath temp-file) (.toPath (io/file path))
+                  (into-array CopyOption [StandardCopyOption/ATOMIC_MOVE StandardCopyOption/REPLACE_EXISTING]))
       (finally
-        (println "Deleting temporary file:" temp-file)
-        (shell "rm" "-f" temp-file)))))
-
-(defn update-hypergraph [base64-image]
-  (when (nil? base64-image)
-    (println "No image data to update.")) ;; Check for nil Base64 string
-  (let [hypergraph-path (str destination-folder "hypergraph.json")
-        hypergraph (if (.exists (io/file hypergraph-path))
-                     (json/parse-string (slurp hypergraph-path) true)
-                     {:nodes [] :hyperedges []})
-        node {:id (uuid-v4) :type "screenshot" :data base64-image :time (timestamp-iso-str) :description (oai-image-description base64-image)}
-        updated-hypergraph (update hypergraph :nodes conj node)]
-;;    (println "Saving updated hypergraph:" updated-hypergraph) ;; Debugging line
-    (save-json-hypergraph updated-hypergraph hypergraph-path)))
-
-;; Main loop to take screenshots every 5 seconds and save them as Base64 in a JSON hypergraph
-(dotimes [_ 1000]
-  (update-hypergraph (capture-screenshot))
-  (Thread/sleep 5000)) ;; Sleep for 5000 milliseconds or 5 seconds
\ No newline at end of file
+        (io/delete-file temp-file true)))))
+
+;; Function to save a screenshot named after its node id into the destination folder.
+;; Returns the file name relative to the destination folder so the hypergraph stays valid if the folder moves.
+(defn capture-screenshot [id]
+  (let [file-name (str id ".png")
+        file-path (str destination-folder file-name)]
+    (println "Capturing screenshot to:" file-path)
+    (shell "screencapture" "-x" file-path)
+    (when (.exists (io/file file-path))
+      (println "Screenshot saved to:" file-path)
+      file-name)))
+
+(def hypergraph-path (str destination-folder "hypergraph.json"))
+
+;; Number of captures to buffer in memory between rewrites of the hypergraph file
+(def flush-every 12)
+
+;; Load the existing hypergraph once so captures don't re-read the file every time
+(defn load-hypergraph [path]
+  (if (.exists (io/file path))
+    (with-open [reader (io/reader path)]
+      (json/parse-stream reader true))
+    {:nodes [] :hyperedges []}))
+
+;; A failed save is logged and skipped; the agent keeps running so capturing continues
+(def hypergraph (agent (load-hypergraph hypergraph-path)
+                       :error-mode :continue
+                       :error-handler (fn [_ e] (println "Error updating hypergraph:" (.getMessage e)))))
+
+;; Write the current hypergraph to disk; queued on the agent so writes never overlap node updates
+(defn flush-hypergraph []
+  (send-off hypergraph (fn [graph]
+                         (save-json-hypergraph graph hypergraph-path)
+                         graph)))
+
+;; Set once the final flush has completed, so the shutdown hook doesn't rewrite the file on a normal exit
+(def done? (atom false))
+
+;; Persist whatever is buffered if the capture loop is interrupted (e.g. Ctrl-C).
+;; Nodes whose descriptions are still in flight are saved with a nil :description.
+(.addShutdownHook (Runtime/getRuntime)
+                  (Thread. (fn []
+                             (when-not @done?
+                               (save-json-hypergraph @hypergraph hypergraph-path)))))
+
+;; Fill in the description of the node with the given id
+(defn set-node-description [graph id description]
+  (update graph :nodes (fn [nodes]
+                         (mapv #(if (= (:id %) id) (assoc % :description description) %) nodes))))
+
+;; Record the node immediately, then describe the screenshot on a future so the slow
+;; vision request doesn't delay the next capture
+(defn update-hypergraph [id image-path]
+  (if (nil? image-path)
+    (println "No image data to update.") ;; Skip the API call and node for a failed capture
+    (let [node {:id id :type "screenshot" :path image-path :time (timestamp-iso-str) :description nil}]
+;;      (println "Adding node to hypergraph:" node) ;; Debugging line
+      (send hypergraph update :nodes conj node)
+      (future
+        ;; On failure the node keeps a nil description, so the saved screenshot stays referenced
+        (try
+          (send hypergraph set-node-description id (oai-image-description (image-to-base64 (str destination-folder image-path))))
+          (catch Exception e
+            (println "Error describing screenshot" image-path ":" (.getMessage e))))))))
+
+;; Main loop to take screenshots every 5 seconds and record them in a JSON hypergraph
+(let [pending (atom [])]
+  (dotimes [i 1000]
+    (let [id (uuid-v4)]
+      (when-let [description-future (update-hypergraph id (capture-screenshot id))]
+        (swap! pending conj description-future)))
+    (when (zero? (mod (inc i) flush-every))
+      (flush-hypergraph))
+    (Thread/sleep 5000)) ;; Sleep for 5000 milliseconds or 5 seconds
+  (run! deref @pending))
+(flush-hypergraph)
+(await hypergraph)
+(reset! done? true)
+(shutdown-agents)
@@ -1,38 +1,23 @@
 #!/usr/bin/env bb
 
-(require '[babashka.process :refer [shell]])
 (require '[cheshire.core :as json])
 (require '[clojure.java.io :as io])
+(require '[clojure.string :as str])
 (require '[clj-http.lite.client :as client])
-(import '(java.util Base64 UUID)
-         '(java.nio.file Files Paths)
-         '(java.text SimpleDateFormat)
-         '(java.util Date))
+(import '(java.util UUID)
+         '(java.nio.file CopyOption Files StandardCopyOption))
 
 (def openai-api-key (System/getenv "OPENAI_API_KEY"))
 (def replicate-api-key (System/getenv "REPLICATE_API_TOKEN"))
 
+;; Set HYPERPLEX_DEBUG (to anything but "", "0" or "false") to print full payloads (OCR text, generated olog) instead of their sizes
+(def debug? (let [value (str/trim (str (System/getenv "HYPERPLEX_DEBUG")))]
+              (not (contains? #{"" "0" "false"} (str/lower-case value)))))
+
 (defn load-system-prompt [file-path]
   (let [file-contents (slurp file-path)]
     file-contents))
 
-;; Function to post base64 image frame to OpenAI API and return the response body
-(defn oai-image-description [frame]
-  (let [response (client/post "https://api.openai.com/v1/chat/completions"
-                              {:headers {"Content-Type" "application/json"
-                                         "Authorization" (str "Bearer " openai-api-key)}
-                               :body (json/generate-string {:model "gpt-4-vision-preview"
-                                                            :messages [{:role "user"
-                                                                        :content [{:type "text"
-                                                                                   :text "What’s in this image?"}
-                                                                                  {:type "image_url"
-                                                                                   :image_url {:url (str "data:image/jpeg;base64," frame)}}]}]
-                                                            :max_tokens 300})
-                               :throw false})]
-    (let [response-body (:body response)]
-      (println "Response body:" response-body)
-      response-body)))
-
 (defn strip-chars [s]
   (subs s 7 (- (count s) 3)))
 
@@ -48,24 +33,35 @@
                                                             :max_tokens 4000})
                                :throw false})]
     (let [response-body (json/parse-string (:body response) true)
-          content (:content (:message (nth (:choices response-body) 0)))]
-      (println "Response content:" (strip-chars content))
-      (strip-chars content))))
+          content (strip-chars (:content (:message (nth (:choices response-body) 0))))]
+      (println "Response content:" (count content) "characters")
+      (when debug? (println "Response content:" content))
+      content)))
+
+;; Replicate error bodies look like {"title" "detail" "status" 401}; fall back to the raw body if it isn't JSON
+(defn replicate-error-detail [body]
+  (try
+    (or (:detail (json/parse-string body true)) body)
+    (catch Exception _
+      body)))
 
 ;; Function to post to nougat hosted on replicate
 (defn ocr-pdf-post [pdf-url]
   (let [response (client/post "https://api.replicate.com/v1/deployments/chartierluc/nougat/predictions"
                               {:headers {"Content-Type" "application/json"
-                                         "Authorization" (str "Token " replicate-api-key)}
+                                         "Authorization" (str "Token " replicate-api-key)
+                                         "Prefer" "wait"} ;; Hold the request open until the prediction finishes (up to 60s)
                                :body (json/generate-string {"version" "fbf959aabb306f7cc83e31da4a5ee0ee78406d11216295dbd9ef75aba9b30538"
                                                          "input" {"document" (str pdf-url)
                                                                   "postprocess" false
                                                                   "early_stopping" false}})
                                :throw false})]
-    (let [response-body (json/parse-string (:body response) true)
-          get-url (:get (:urls response-body))]
-      (println "GET URL:" get-url)
-      get-url)))
+    ;; Check the status before parsing: gateway errors (502/504) can return HTML instead of JSON
+    (when-not (<= 200 (:status response) 299)
+      (throw (Exception. (str "Error creating prediction (HTTP " (:status response) "): " (replicate-error-detail (:body response))))))
+    (let [response-body (json/parse-string (:body response) true)]
+      (println "GET URL:" (:get (:urls response-body)))
+      response-body)))
 
 (defn ocr-pdf-get [prediction-url]
   (let [response (client/get prediction-url {:headers {"Authorization" (str "Token " replicate-api-key)}})
@@ -74,83 +70,56 @@
     ;;(println "Response Body:" response-body)
     response-body)) ;; Return the full response body or a reduced form
 
-(defn ocr-pdf-poll [prediction-url]
-  (Thread/sleep 2000) ;; Initial wait for 2 seconds
-  (loop []
-    (let [response (ocr-pdf-get prediction-url)
-          body (json/parse-string (:body response) true)
-          status (:status response)]
+;; Start from the prediction returned by ocr-pdf-post and only poll if it is still running
+(defn ocr-pdf-poll [prediction]
+  (loop [response prediction]
+    (let [status (:status response)]
       (println "Current Status:" status)
-      (cond
-        (= status "succeeded") (:output response) ;; Return the output URL when status is 'succeeded'
-        (= status "error") (throw (Exception. "Error in processing"))
-        :else (do (Thread/sleep 1000) ;; Poll every second
-                  (recur))))))
+      (case status
+        "succeeded" (:output response) ;; Return the output URL when status is 'succeeded'
+        ("failed" "canceled" "error") (throw (Exception. (str "Error in processing: " (or (:error response) status))))
+        (do (Thread/sleep 1000) ;; Poll every second
+            (recur (ocr-pdf-get (:get (:urls prediction)))))))))
 
 (defn fetch-url-contents [url]
   (let [response (client/get url)
-        contents (:body response)]
-    (println "Fetched Content:" (strip-chars contents))
-    (strip-chars contents)))
-
-;; Define the destination folder on the desktop
-(def destination-folder (str (System/getProperty "user.home") "/Desktop/hypergraph/"))
-
-;; Create the directory if it does not exist
-(shell "mkdir" "-p" destination-folder)
-
-;; Function to generate a timestamp string in ISO 8601 format
-(defn timestamp-iso-str []
-  (let [sdf (SimpleDateFormat. "yyyy-MM-dd'T'HH:mm:ss'Z'")]
-    (.format sdf (Date.))))
+        contents (strip-chars (:body response))]
+    (println "Fetched Content:" (count contents) "characters")
+    (when debug? (println "Fetched Content:" contents))
+    contents))
 
-;; Function to generate a UUID v4 string
-(defn uuid-v4 []
-  (.toString (UUID/randomUUID)))
-
-;; Function to convert image to base64
-(defn image-to-base64 [path]
-  (try
-    (let [file-path (Paths/get path (make-array String 0))]
-      (let [file-content (Files/readAllBytes file-path)]
-        (.encodeToString (Base64/getEncoder) file-content)))
-    (catch Exception e
-      (println "Error converting image to Base64:" (.getMessage e))
-      nil))) ;; Return nil to indicate failure
-
-;; Function to save a JSON hypergraph to a file
+;; Function to save a JSON hypergraph to a file, replacing it atomically
 (defn save-json-hypergraph [json-object path]
-  (with-open [writer (io/writer path)]
-    (.write writer (json/generate-string json-object))
-    (.flush writer)))
-
-;; Function to save screenshot
-(defn capture-screenshot []
-  (let [temp-file (str "/tmp/" (uuid-v4) ".png")]
-    (println "Capturing screenshot to:" temp-file)
-    (shell "screencapture" "-x" temp-file)
+  ;; Unique temp name so overlapping saves (e.g. the shutdown hook during a flush) never share a file
+  (let [temp-file (io/file (str path "." (UUID/randomUUID) ".tmp"))]
     (try
-      (let [file (io/file temp-file)]
-        (when (.exists file)
-          (println "Screenshot saved to:" (.getAbsolutePath file))
-          (let [base64 (image-to-base64 temp-file)]
-  ;;          (println "Base64 string:" base64) ;; This will print the Base64 string
-            base64)))
-      (catch Exception e
-        (println "Error capturing screenshot:" (.getMessage e)))
+      (with-open [writer (io/writer temp-file)]
+        (json/generate-stream json-object writer))
+      ;; Swap the finished file into place so an interrupted write never truncates the hypergraph
+      (Files/move (.toPath temp-file) (.toPath (io/file path))
+                  (into-array CopyOption [StandardCopyOption/ATOMIC_MOVE StandardCopyOption/REPLACE_EXISTING]))
       (finally
-        (println "Deleting temporary file:" temp-file)
-        (shell "rm" "-f" temp-file)))))
+        (io/delete-file temp-file true)))))
 
 ;; Apend JSON to the existing JSON hypergraph
 (defn append-to-hypergraph [json-input file-path]
   (let [new-data (json/parse-string json-input true)
         existing-data (if (.exists (io/file file-path))
-                        (json/parse-string (slurp file-path) true)
-                        {"nodes" [], "hyperedges" []})
-        updated-data (merge-with into existing-data new-data)]
-    (with-open [writer (io/writer file-path)]
-      (.write writer (json/generate-string updated-data)))))
+                        (with-open [reader (io/reader file-path)]
+                          (json/parse-stream reader true))
+                        {:nodes [] :hyperedges []})
+        ;; Only the node and hyperedge lists accumulate; other keys (e.g. "title") keep the first value seen.
+        ;; Only byte-identical entries are skipped; a regenerated entry that differs is kept alongside the old one.
+        updated-data (reduce (fn [data k]
+                               (update data k #(vec (distinct (into % (k new-data))))))
+                             (merge new-data existing-data)
+                             [:nodes :hyperedges])]
+    ;; Flag ids that now appear with different content so conflicting entries can be reviewed by hand
+    (doseq [k [:nodes :hyperedges]
+            [id entries] (group-by :id (k updated-data))
+            :when (and (some? id) (> (count entries) 1))]
+      (println "Warning:" (count entries) "different" (name k) "share id" id))
+    (save-json-hypergraph updated-data file-path)))
 
 (defn -main [& args]
   (let [pdf-url (first args)]